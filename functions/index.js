@@ -114,12 +114,22 @@ if (!admin.apps.length) {
 
 const db = admin.firestore();
 
+// The Firestore client opens an extra gRPC channel whenever a channel hits its
+// concurrent-stream limit (e.g. during the partitioned workoutLogs migration).
+// Keep a few of those warm between bursts instead of closing all but one.
+db.settings({ maxIdleChannels: 4 });
+
 /**
  * Cloud Function to migrate workoutLogs by adding a 'completedDate' field
  * with the value from the existing 'date' field.
  * This function is designed to be called manually (e.g., via HTTP request or a simple script).
+ * Running it as a function keeps every read/write RPC next to Firestore instead of
+ * paying client-to-region latency from a workstation; the runtime options give a
+ * full scan the maximum 1st-gen timeout and enough memory for the parallel shards.
  */
-exports.migrateWorkoutLogsCompletedDate = functions.https.onCall(async (data, context) => {
+exports.migrateWorkoutLogsCompletedDate = functions
+  .runWith({ timeoutSeconds: 540, memory: '1GB' })
+  .https.onCall(async (data, context) => {
   // --- IMPORTANT: Security Check ---
   // For a one-off migration, you might trigger this from a trusted environment.
   // If you plan to expose this, add strong authentication and authorization checks here.
@@ -129,70 +139,223 @@ exports.migrateWorkoutLogsCompletedDate = functions.https.onCall(async (data, co
   // }
 
   const collectionGroupRef = db.collectionGroup('workoutLogs');
-  const BATCH_SIZE = 400; // Keep it below Firestore's 500 limit for safety
-  let documentsProcessed = 0;
-  let lastDocSnapshot = null; // No type annotation needed for JavaScript
-  let continueProcessing = true;
-
-  functions.logger.info('Starting migration of workoutLogs to add completedDate...');
+  const BATCH_SIZE = 400; // Page size for reads; BulkWriter handles write batching itself
+  const SHARD_COUNT = 16; // Desired number of key-range partitions scanned concurrently
+
+  // BulkWriter dispatches writes in parallel instead of waiting on one
+  // batch.commit() round-trip per page. These throttling values are BulkWriter's
+  // defaults, pinned explicitly: it starts at 500 ops/s and applies Firestore's
+  // 500/50/5 ramp (+50% every 5 minutes) itself, and maxOpsPerSecond only caps
+  // how high that ramp can climb.
+  const bulkWriter = db.bulkWriter({
+    throttling: {
+      initialOpsPerSecond: 500,
+      maxOpsPerSecond: 10000,
+    },
+  });
 
-  try {
-    while (continueProcessing) {
-      let query = collectionGroupRef
-        .orderBy(admin.firestore.FieldPath.documentId()) // Order by document ID for consistent pagination across all subcollections
-        .limit(BATCH_SIZE);
+  // Retry transient failures per write (BulkWriter backs off exponentially between
+  // attempts) so one bad write doesn't abort the whole migration.
+  const MAX_WRITE_ATTEMPTS = 5;
+  const RETRYABLE_WRITE_CODES = new Set([
+    4,  // DEADLINE_EXCEEDED
+    8,  // RESOURCE_EXHAUSTED
+    10, // ABORTED
+    14, // UNAVAILABLE
+  ]);
+  let failedWrites = 0;
+
+  // Per-page progress is accumulated here and logged on a timer, so log volume
+  // scales with run time rather than with the number of pages across all shards.
+  const PROGRESS_LOG_INTERVAL_MS = 10000;
+  const progress = { pages: 0, emptyPages: 0, documents: 0, updates: 0 };
+  const logProgress = () => {
+    functions.logger.info(
+      `Migration progress: ${progress.documents} documents scanned in ${progress.pages} pages ` +
+      `(${progress.emptyPages} with nothing to update), ${progress.updates} updates queued, ` +
+      `${failedWrites} failed writes.`
+    );
+  };
+  let progressTimer = null;
 
-      if (lastDocSnapshot) {
-        query = query.startAfter(lastDocSnapshot);
-      }
+  bulkWriter.onWriteError((error) => {
+    if (RETRYABLE_WRITE_CODES.has(error.code) && error.failedAttempts < MAX_WRITE_ATTEMPTS) {
+      return true;
+    }
+    functions.logger.warn(`Giving up on ${error.documentRef.path} after ${error.failedAttempts} attempts: ${error.message}`);
+    return false;
+  });
 
-      const snapshot = await query.get();
+  const buildPageQuery = (partitionQuery, startAfterRef) => {
+    // Only 'date' and 'completedDate' are needed; projecting them avoids
+    // downloading the exercises/sets payload of every workout log.
+    let query = partitionQuery
+      .select('date', 'completedDate')
+      .limit(BATCH_SIZE);
+
+    // Partition queries are ordered by document ID, so the cursor only needs the
+    // last document's reference rather than its whole snapshot.
+    if (startAfterRef) {
+      query = query.startAfter(startAfterRef);
+    }
 
-      if (snapshot.empty) {
-        continueProcessing = false;
-        functions.logger.info('No more documents found.');
-        break;
-      }
+    return query;
+  };
 
-      const batch = db.batch();
-      let updatesInBatch = 0;
+  // Set once any partition fails, so the others stop reading and queueing writes
+  // instead of carrying on after the function has reported the failure.
+  let aborted = false;
+
+  // Pages through a single partition. Each partition keeps its own cursor, so
+  // partitions run independently and only ever touch disjoint documents.
+  const migratePartition = async (partitionQuery) => {
+    let documentsProcessed = 0;
+    let lastDocRef = null;
+    let continueProcessing = true;
+    // The previous page's flush is only awaited after the next page has been
+    // read, so each page's read round-trip overlaps with the prior page's writes.
+    let pendingFlush = Promise.resolve();
+
+    while (continueProcessing && !aborted) {
+      let docsInPage = 0;
+      let updatesInPage = 0;
+
+      // Stream the page straight into the BulkWriter instead of buffering every
+      // snapshot; only the last reference and the counters outlive each document.
+      for await (const doc of buildPageQuery(partitionQuery, lastDocRef).stream()) {
+        if (aborted) {
+          break;
+        }
+        docsInPage++;
+        lastDocRef = doc.ref;
 
-      snapshot.docs.forEach(doc => {
-        const docData = doc.data();
+        // Probe the two fields directly rather than decoding the document with data()
+        const date = doc.get('date');
         // Only update if 'date' exists AND 'completedDate' does NOT exist
         // This makes the script "idempotent" – running it multiple times won't cause issues
-        if (docData.date && !docData.completedDate) {
+        if (date && !doc.get('completedDate')) {
           // Assuming 'date' is a Firestore Timestamp.
           // If 'date' is a string, you might need to parse it:
-          // const dateToSet = new Date(docData.date); // Or new admin.firestore.Timestamp(dateToSet.getTime() / 1000, 0);
-          batch.update(doc.ref, { completedDate: docData.date });
-          updatesInBatch++;
+          // const dateToSet = new Date(date); // Or new admin.firestore.Timestamp(dateToSet.getTime() / 1000, 0);
+          // Firestore has no field-copy transform (only serverTimestamp, increment,
+          // maximum/minimum and array union/remove), so the value has to be echoed
+          // back; the select() projection keeps that read down to these two fields.
+          // The field/value form skips building and walking an update map to derive
+          // the field mask, which adds up over every document in the scan.
+          bulkWriter.update(doc.ref, 'completedDate', date).catch(() => {
+            failedWrites++;
+          });
+          updatesInPage++;
         }
-      });
+      }
+
+      await pendingFlush;
+
+      if (docsInPage === 0) {
+        break;
+      }
 
-      if (updatesInBatch > 0) {
-        await batch.commit();
-        functions.logger.info(`Committed batch of ${updatesInBatch} updates.`);
+      progress.pages++;
+      progress.documents += docsInPage;
+      progress.updates += updatesInPage;
+
+      if (updatesInPage > 0) {
+        pendingFlush = bulkWriter.flush();
       } else {
-        functions.logger.info('No documents needing update in this batch.');
+        progress.emptyPages++;
       }
 
-      documentsProcessed += snapshot.docs.length;
-      lastDocSnapshot = snapshot.docs[snapshot.docs.length - 1];
+      documentsProcessed += docsInPage;
 
-      // If the number of documents in the snapshot is less than BATCH_SIZE,
+      // If the number of documents in the page is less than BATCH_SIZE,
       // it means we've processed the last page.
-      if (snapshot.docs.length < BATCH_SIZE) {
+      if (docsInPage < BATCH_SIZE) {
         continueProcessing = false;
       }
     }
 
+    await pendingFlush;
+    return documentsProcessed;
+  };
+
+  // Firestore indexes never contain documents that lack a field, so "completedDate
+  // is missing" can't be expressed as a query filter. Instead, record a marker once
+  // a full pass succeeds and skip the scan entirely on later runs unless forced.
+  const migrationMarkerRef = db.collection('migrations').doc('workoutLogsCompletedDate');
+  const force = Boolean(data && data.force);
+
+  functions.logger.info('Starting migration of workoutLogs to add completedDate...');
+
+  try {
+    if (!force) {
+      const markerDoc = await migrationMarkerRef.get();
+      if (markerDoc.exists) {
+        functions.logger.info('Migration already completed; skipping scan. Pass { force: true } to re-run.');
+        await bulkWriter.close();
+        return { success: true, documentsProcessed: 0, message: 'Migration already completed.' };
+      }
+    }
+
+    // getPartitions() splits the collection group into contiguous document-key
+    // ranges (ordered by document ID), which is how Firestore supports
+    // parallel scans of a collection group.
+    const partitionQueries = [];
+    for await (const partition of collectionGroupRef.getPartitions(SHARD_COUNT)) {
+      partitionQueries.push(partition.toQuery());
+    }
+
+    functions.logger.info(`Scanning workoutLogs in ${partitionQueries.length} partitions.`);
+    progressTimer = setInterval(logProgress, PROGRESS_LOG_INTERVAL_MS);
+
+    // allSettled (rather than all) waits for every partition to wind down after a
+    // failure, so nothing is still reading or queueing writes once this returns.
+    const partitionResults = await Promise.allSettled(
+      partitionQueries.map((partitionQuery) =>
+        migratePartition(partitionQuery).catch((error) => {
+          aborted = true;
+          throw error;
+        })
+      )
+    );
+    const failedPartition = partitionResults.find((result) => result.status === 'rejected');
+    if (failedPartition) {
+      throw failedPartition.reason;
+    }
+    const documentsProcessed = partitionResults.reduce((total, result) => total + result.value, 0);
+
+    await bulkWriter.close();
+    clearInterval(progressTimer);
+    logProgress();
+
+    if (failedWrites > 0) {
+      // Leave the marker unset so the next run rescans and retries these documents.
+      functions.logger.warn(`Migration finished with ${failedWrites} failed writes. Re-run to retry them.`);
+      return {
+        success: false,
+        documentsProcessed,
+        failedWrites,
+        message: `Migration finished with ${failedWrites} failed writes.`
+      };
+    }
+
+    await migrationMarkerRef.set({
+      documentsProcessed,
+      completedAt: admin.firestore.FieldValue.serverTimestamp(),
+    });
+
     functions.logger.info(`Migration complete! Processed ${documentsProcessed} total documents.`);
-    return { success: true, documentsProcessed, message: 'Migration completed successfully.' };
+    return { success: true, documentsProcessed, failedWrites, message: 'Migration completed successfully.' };
 
   } catch (error) { // Removed ': any'
     functions.logger.error('Error during workoutLogs migration:', error);
     throw new functions.https.HttpsError('internal', 'Migration failed', error.message);
+  } finally {
+    clearInterval(progressTimer);
+    // Let any queued writes settle before returning; close() is a no-op once the
+    // writer has already been closed on the success paths above.
+    await bulkWriter.close().catch((error) => {
+      functions.logger.error('Error closing BulkWriter:', error);
+    });
   }
 });
 
@@ -1,15 +1,41 @@
 import os
+import sys
 import json
+import math
+import hashlib
+import time
+import array
+import bisect
+import heapq
+import queue
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from itertools import groupby
 import firebase_admin
 from firebase_admin import credentials, firestore
+from google.api_core import exceptions as google_exceptions
 
 # --- Configuration ---
 # Place your Firebase Admin SDK service account key file in the same directory
 # as this script, or provide the path to it.
 SERVICE_ACCOUNT_KEY_PATH = 'sample-firebase-ai-app-d056c-firebase-adminsdk-fbsvc-047d03194a.json'
 
-def process_workouts():
+# Exercise metadata and user bodyweights rarely change, so they are kept in a
+# local file between runs and only re-read from Firestore once it is older than
+# the TTL or was built for a different project. Delete the file to force a refresh.
+LOOKUP_CACHE_PATH = '.workout_analytics_cache.json'
+LOOKUP_CACHE_TTL_SECONDS = 24 * 60 * 60
+
+# Content hashes of the analytics documents written by the previous run against
+# the same Firebase project and database, keyed by document path. Documents whose
+# content is unchanged are not rewritten. Firestore itself is not checked, so a
+# document deleted or edited outside this script since the previous run is not
+# detected; run with --force-write (or delete the file) to write every document again.
+WRITTEN_HASHES_PATH = '.workout_analytics_written.json'
+
+def process_workouts(force_write=False):
     """
     Enhanced workout processing function that mirrors the JavaScript processWorkout functionality.
     Processes completed workout logs from Firestore, aggregates user analytics with advanced features,
@@ -24,6 +50,9 @@ def process_workouts():
     - Plateau detection
     - Muscle balance calculations
     - Proper handling of existing analytics data
+
+    With force_write, every analytics document is written even if its content
+    hash matches the previous run.
     """
     # --- Initialize Firebase Admin SDK ---
     if not os.path.exists(SERVICE_ACCOUNT_KEY_PATH):
@@ -55,16 +84,114 @@ def process_workouts():
         '15RM': {'min': 13, 'max': 20}
     }
 
+    # Rep count -> category lookup for integer rep counts covered by REP_RANGES;
+    # anything not covered falls back to '15RM' just like the range scan
+    REP_RANGE_LOOKUP = ['15RM'] * (max(r['max'] for r in REP_RANGES.values()) + 1)
+    for category, range_data in REP_RANGES.items():
+        for rep_count in range(range_data['min'], range_data['max'] + 1):
+            REP_RANGE_LOOKUP[rep_count] = category
+
     # RPE to percentage of 1RM mapping (approximate)
     RPE_TO_PERCENTAGE = {
         10: 1.00, 9.5: 0.98, 9: 0.96, 8.5: 0.94, 8: 0.92,
         7.5: 0.90, 7: 0.88, 6.5: 0.86, 6: 0.84, 5: 0.82
     }
 
+    # Parallel lists sorted by percentage so the closest RPE can be found with bisect
+    RPE_SORTED_ITEMS = sorted(RPE_TO_PERCENTAGE.items(), key=lambda item: item[1])
+    RPE_SORTED_PERCENTAGES = [pct for _, pct in RPE_SORTED_ITEMS]
+    RPE_SORTED_VALUES = [float(rpe) for rpe, _ in RPE_SORTED_ITEMS]
+
+    DEFAULT_EXERCISE_METADATA = {
+        'name': 'Unknown',
+        'muscleGroup': 'Unknown',
+        'exerciseType': 'Unknown',
+        'isCompoundLift': False,
+        'movementPattern': 'Unknown',
+        'equipment': 'Unknown'
+    }
+
+    # Only these fields are read from users/exercises documents, so reads are
+    # projected to them instead of downloading whole documents
+    USER_FIELD_PATHS = ['weightLbs']
+    EXERCISE_FIELD_PATHS = ['name', 'primaryMuscleGroup', 'exerciseType', 'movementPattern', 'equipment']
+
+    # Finished logs are read in pages of this size rather than one unbounded stream
+    LOG_PAGE_SIZE = 500
+
+    # Firestore rejects batches of more than 500 writes; large users are split
+    # into several batches kept safely under that limit
+    BATCH_OP_LIMIT = 450
+
+    # Per-user batch commits are network-bound, so they run concurrently
+    COMMIT_WORKERS = 40
+    # Users aggregated but not yet committed; processing waits once this many are queued
+    MAX_PENDING_WRITES = COMMIT_WORKERS * 2
+    # Commits failing with these transient errors are retried with backoff
+    COMMIT_MAX_ATTEMPTS = 5
+    RETRYABLE_COMMIT_ERRORS = (
+        google_exceptions.Aborted,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.ServiceUnavailable,
+    )
+
     # --- In-memory data stores ---
-    all_users_analytics = {}
+    all_users_analytics = defaultdict(lambda: {
+        "exercise_analytics": {},
+        "monthly_analytics": {}
+    })
     user_bodyweight_cache = {}
     exercise_metadata_cache = {}
+    # Ids whose cached value is a fallback from a failed read; never persisted
+    failed_lookup_ids = set()
+    lookup_cache_created_at = time.time()
+
+    def intern_metadata_keys(metadata):
+        """Intern the metadata strings used as volume map keys, so the per-workout
+        muscle group and compound lift dicts match them by identity."""
+        for field in ('name', 'muscleGroup'):
+            if isinstance(metadata.get(field), str):
+                metadata[field] = sys.intern(metadata[field])
+        return metadata
+
+    # The project and database the local state files are built against, so state
+    # from another project, database or emulator is never reused
+    firestore_target = {
+        'projectId': cred.project_id,
+        'database': getattr(db, '_database', '(default)'),
+        'emulatorHost': os.environ.get('FIRESTORE_EMULATOR_HOST'),
+    }
+
+    # --- Load lookup caches persisted by a previous run ---
+    if os.path.exists(LOOKUP_CACHE_PATH):
+        try:
+            with open(LOOKUP_CACHE_PATH) as cache_file:
+                cached = json.load(cache_file)
+            if cached.get('target') != firestore_target:
+                print(f"Lookup cache '{LOOKUP_CACHE_PATH}' was built for a different Firestore project; refreshing from Firestore.")
+            elif time.time() - cached.get('createdAt', 0) < LOOKUP_CACHE_TTL_SECONDS:
+                user_bodyweight_cache.update(cached.get('userBodyweights', {}))
+                for exercise_id, metadata in cached.get('exerciseMetadata', {}).items():
+                    exercise_metadata_cache[exercise_id] = intern_metadata_keys(metadata)
+                lookup_cache_created_at = cached['createdAt']
+                print(f"Loaded {len(exercise_metadata_cache)} exercises and {len(user_bodyweight_cache)} users from '{LOOKUP_CACHE_PATH}'.")
+            else:
+                print(f"Lookup cache '{LOOKUP_CACHE_PATH}' is stale; refreshing from Firestore.")
+        except Exception as e:
+            print(f"Error loading lookup cache '{LOOKUP_CACHE_PATH}': {e}")
+
+    previous_written_hashes = {}
+    written_hashes = {}
+    if not force_write and os.path.exists(WRITTEN_HASHES_PATH):
+        try:
+            with open(WRITTEN_HASHES_PATH) as hashes_file:
+                stored_hashes = json.load(hashes_file)
+            if stored_hashes.get('target') == firestore_target:
+                previous_written_hashes = stored_hashes.get('hashes', {})
+            else:
+                print(f"Written document hashes '{WRITTEN_HASHES_PATH}' were recorded for a different Firestore project; writing every document.")
+        except Exception as e:
+            print(f"Error loading written document hashes '{WRITTEN_HASHES_PATH}': {e}")
 
     # --- Helper Functions ---
     def normalize_datetime(dt):
@@ -87,7 +214,7 @@ def process_workouts():
         if user_id in user_bodyweight_cache:
             return user_bodyweight_cache[user_id]
         try:
-            user_doc = db.collection('users').document(user_id).get()
+            user_doc = db.collection('users').document(user_id).get(field_paths=USER_FIELD_PATHS)
             if user_doc.exists:
                 user_data = user_doc.to_dict()
                 bodyweight = user_data.get('weightLbs', 0)
@@ -99,51 +226,146 @@ def process_workouts():
         except Exception as e:
             print(f"Error fetching user profile for {user_id}: {e}")
             user_bodyweight_cache[user_id] = 0
+            failed_lookup_ids.add(user_id)
             return 0
 
+    def build_exercise_metadata(data):
+        """Build the cached metadata dict from an exercise document's data."""
+        exercise_name = data.get('name', 'Unknown')
+        return intern_metadata_keys({
+            'name': exercise_name,
+            'muscleGroup': data.get('primaryMuscleGroup', 'Unknown'),
+            'exerciseType': data.get('exerciseType', 'Unknown'),
+            'isCompoundLift': exercise_name.lower() in COMPOUND_LIFTS,
+            'movementPattern': data.get('movementPattern', 'Unknown'),
+            'equipment': data.get('equipment', 'Unknown')
+        })
+
     def get_exercise_metadata(exercise_id):
         """Get exercise metadata from cache or fetch from Firestore."""
         if exercise_id in exercise_metadata_cache:
             return exercise_metadata_cache[exercise_id]
         try:
-            doc = db.collection('exercises').document(exercise_id).get()
+            doc = db.collection('exercises').document(exercise_id).get(field_paths=EXERCISE_FIELD_PATHS)
             if doc.exists:
-                data = doc.to_dict()
-                exercise_name = data.get('name', 'Unknown')
-                metadata = {
-                    'name': exercise_name,
-                    'muscleGroup': data.get('primaryMuscleGroup', 'Unknown'),
-                    'exerciseType': data.get('exerciseType', 'Unknown'),
-                    'isCompoundLift': exercise_name.lower() in COMPOUND_LIFTS,
-                    'movementPattern': data.get('movementPattern', 'Unknown'),
-                    'equipment': data.get('equipment', 'Unknown')
-                }
+                metadata = build_exercise_metadata(doc.to_dict())
                 exercise_metadata_cache[exercise_id] = metadata
                 return metadata
             else:
-                default_metadata = {
-                    'name': 'Unknown',
-                    'muscleGroup': 'Unknown',
-                    'exerciseType': 'Unknown',
-                    'isCompoundLift': False,
-                    'movementPattern': 'Unknown',
-                    'equipment': 'Unknown'
-                }
+                default_metadata = dict(DEFAULT_EXERCISE_METADATA)
                 exercise_metadata_cache[exercise_id] = default_metadata
                 return default_metadata
         except Exception as e:
             print(f"Error fetching exercise metadata for {exercise_id}: {e}")
-            default_metadata = {
-                'name': 'Unknown',
-                'muscleGroup': 'Unknown',
-                'exerciseType': 'Unknown',
-                'isCompoundLift': False,
-                'movementPattern': 'Unknown',
-                'equipment': 'Unknown'
-            }
+            default_metadata = dict(DEFAULT_EXERCISE_METADATA)
             exercise_metadata_cache[exercise_id] = default_metadata
+            failed_lookup_ids.add(exercise_id)
             return default_metadata
 
+    def prefetch_user_bodyweights(user_ids):
+        """Warm the bodyweight cache with a single batched get_all read."""
+        try:
+            refs = [db.collection('users').document(user_id) for user_id in user_ids if user_id not in user_bodyweight_cache]
+            if not refs:
+                return
+            for user_doc in db.get_all(refs, field_paths=USER_FIELD_PATHS):
+                user_data = user_doc.to_dict() if user_doc.exists else {}
+                user_bodyweight_cache[user_doc.id] = user_data.get('weightLbs', 0)
+        except Exception as e:
+            # Anything not cached here falls back to a per-user read on first use
+            print(f"Error prefetching user profiles: {e}")
+
+    def prefetch_exercise_metadata(exercise_ids):
+        """Warm the exercise metadata cache with a single batched get_all read."""
+        try:
+            refs = [db.collection('exercises').document(exercise_id) for exercise_id in exercise_ids if exercise_id not in exercise_metadata_cache]
+            if not refs:
+                return
+            for doc in db.get_all(refs, field_paths=EXERCISE_FIELD_PATHS):
+                if doc.exists:
+                    exercise_metadata_cache[doc.id] = build_exercise_metadata(doc.to_dict())
+                else:
+                    exercise_metadata_cache[doc.id] = dict(DEFAULT_EXERCISE_METADATA)
+        except Exception as e:
+            # Anything not cached here falls back to a per-exercise read on first use
+            print(f"Error prefetching exercise metadata: {e}")
+
+    def stream_finished_logs():
+        """Yield finished workout logs page by page, paging on a document-id cursor."""
+        query = (
+            db.collection_group('workoutLogs')
+            .where('isWorkoutFinished', '==', True)
+            .order_by(firestore.FieldPath.document_id())
+            .limit(LOG_PAGE_SIZE)
+        )
+        last_doc = None
+        while True:
+            page_query = query.start_after(last_doc) if last_doc else query
+            docs_in_page = 0
+            for doc in page_query.stream():
+                docs_in_page += 1
+                last_doc = doc
+                yield doc
+            if docs_in_page < LOG_PAGE_SIZE:
+                return
+
+    def read_finished_logs():
+        """Yield (log_id, log_data) for finished logs, reading and decoding them on a
+        background thread so the next page's fetch overlaps with processing here."""
+        decoded_logs = queue.Queue(maxsize=LOG_PAGE_SIZE * 2)
+        stop_reading = threading.Event()
+        end_of_logs = object()
+
+        def read_logs():
+            try:
+                for log in stream_finished_logs():
+                    if stop_reading.is_set():
+                        return
+                    decoded_logs.put((log.id, log.to_dict()))
+            finally:
+                decoded_logs.put(end_of_logs)
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            reader = executor.submit(read_logs)
+            try:
+                while True:
+                    item = decoded_logs.get()
+                    if item is end_of_logs:
+                        break
+                    yield item
+            finally:
+                # If the consumer stops early, drain the queue so the reader can exit
+                stop_reading.set()
+                while not reader.done():
+                    try:
+                        decoded_logs.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+            reader.result()  # Re-raise any error from the reader thread
+
+    def save_lookup_caches():
+        """Persist the lookup caches for the next run, skipping fallback values from failed reads."""
+        def persistable(cache):
+            return {key: value for key, value in cache.items() if isinstance(key, str) and key not in failed_lookup_ids}
+        try:
+            with open(LOOKUP_CACHE_PATH, 'w') as cache_file:
+                json.dump({
+                    'target': firestore_target,
+                    'createdAt': lookup_cache_created_at,
+                    'userBodyweights': persistable(user_bodyweight_cache),
+                    'exerciseMetadata': persistable(exercise_metadata_cache),
+                }, cache_file)
+        except Exception as e:
+            print(f"Error saving lookup cache '{LOOKUP_CACHE_PATH}': {e}")
+
+    def get_month_key(workout_date):
+        """Integer month key (year * 12 + month - 1) of a workout date, or None if there is no date."""
+        return workout_date.year * 12 + workout_date.month - 1 if workout_date else None
+
+    def format_month_key(month_key):
+        """Format an integer month key as its 'YYYY-MM' monthlyAnalytics document id."""
+        return f"{month_key // 12:04d}-{month_key % 12 + 1:02d}"
+
     def calculate_effective_rpe(weight, reps, e1rm):
         """Calculate effective RPE based on percentage of e1RM and rep count."""
         if e1rm == 0:
@@ -154,36 +376,31 @@ def process_workouts():
         # Adjust for rep count - higher reps at same percentage = higher RPE
         rep_adjustment = max(0, (reps - 5) * 0.02)
         adjusted_percentage = percentage + rep_adjustment
+
+        # A non-finite percentage (e.g. from an infinite logged weight) is no closer
+        # to any RPE than another, so keep the default low RPE
+        if not math.isfinite(adjusted_percentage):
+            return 5
         
-        # Find closest RPE
-        closest_rpe = 5
-        min_diff = float('inf')
-        
-        for rpe, pct in RPE_TO_PERCENTAGE.items():
-            diff = abs(adjusted_percentage - pct)
-            if diff < min_diff:
-                min_diff = diff
-                closest_rpe = float(rpe)
-        
-        return closest_rpe
+        # Find closest RPE; the nearest percentage is one of the two neighbours of
+        # the insertion point (ties go to the higher RPE)
+        i = bisect.bisect_left(RPE_SORTED_PERCENTAGES, adjusted_percentage)
+        if i == 0:
+            return RPE_SORTED_VALUES[0]
+        if i == len(RPE_SORTED_PERCENTAGES):
+            return RPE_SORTED_VALUES[-1]
+        if RPE_SORTED_PERCENTAGES[i] - adjusted_percentage <= adjusted_percentage - RPE_SORTED_PERCENTAGES[i - 1]:
+            return RPE_SORTED_VALUES[i]
+        return RPE_SORTED_VALUES[i - 1]
+
+    def calculate_effective_reps(set_weights, set_reps, e1rm):
+        """Calculate effective reps (reps performed at RPE 7+ equivalent).
 
-    def calculate_effective_reps(sets, e1rm):
-        """Calculate effective reps (reps performed at RPE 7+ equivalent)."""
+        Takes the sets as parallel weight/rep lists rather than a list of set dicts.
+        """
         effective_reps = 0
         
-        # Ensure sets is iterable
-        if not isinstance(sets, (list, tuple)):
-            print(f"Warning: sets parameter is not iterable: {type(sets)}")
-            return 0
-        
-        for set_data in sets:
-            if not isinstance(set_data, dict):
-                print(f"Warning: set_data is not a dictionary: {type(set_data)}")
-                continue
-                
-            weight = set_data.get('weight', 0)
-            reps = set_data.get('reps', 0)
-            
+        for weight, reps in zip(set_weights, set_reps):
             if reps > 0 and weight > 0:
                 rpe = calculate_effective_rpe(weight, reps, e1rm)
                 if rpe >= 7:
@@ -195,44 +412,106 @@ def process_workouts():
 
     def get_rep_range_category(reps):
         """Determine rep range category for PR tracking."""
+        if type(reps) is int:
+            return REP_RANGE_LOOKUP[reps] if 0 <= reps < len(REP_RANGE_LOOKUP) else '15RM'
+        # Non-integer rep counts (e.g. floats from older clients) use the range scan
         for category, range_data in REP_RANGES.items():
             if reps >= range_data['min'] and reps <= range_data['max']:
                 return category
         return '15RM'  # Default for high rep work
 
+    def is_current_set_format(exercise):
+        """Whether an exercise uses the current 'sets' array rather than the historical parallel arrays."""
+        return 'sets' in exercise and isinstance(exercise['sets'], list)
+
+    def historical_set_count(exercise):
+        """Number of sets recorded in the historical reps/weights/completed arrays."""
+        return min(len(exercise.get('reps', [])), len(exercise.get('weights', [])), len(exercise.get('completed', [])))
+
+    def iter_completed_sets(exercise):
+        """Yield (weight, reps) for every completed set with reps, for either data structure."""
+        if is_current_set_format(exercise):
+            # Current data structure with sets array
+            for set_data in exercise['sets']:
+                weight = set_data.get('weight', 0)
+                reps = set_data.get('reps', 0)
+                if reps > 0:
+                    yield weight, reps
+        else:
+            # Historical data structure with separate arrays; only completed sets count
+            reps_list = exercise.get('reps', [])
+            weight_list = exercise.get('weights', [])
+            completed_list = exercise.get('completed', [])
+            for i in range(historical_set_count(exercise)):
+                if completed_list[i]:
+                    reps = int(reps_list[i]) if reps_list[i] else 0
+                    weight = int(weight_list[i]) if weight_list[i] else 0
+                    if reps > 0:
+                        yield weight, reps
+
+    def is_finite_number(value):
+        """Whether a set value or bodyweight is a real, finite number."""
+        return isinstance(value, (int, float)) and math.isfinite(value)
+
+    def parse_completed_sets(exercise):
+        """Parse an exercise's completed (weight, reps) sets into a list, or return None if
+        its set data is malformed (unparseable, non-numeric or non-finite values)."""
+        try:
+            completed_sets = list(iter_completed_sets(exercise))
+        except Exception:
+            return None
+        if all(is_finite_number(weight) and is_finite_number(reps) for weight, reps in completed_sets):
+            return completed_sets
+        return None
+
+    def get_workout_exercise_index(workout_data):
+        """Map exerciseId -> first matching exercise in a workout, memoized on the decoded log."""
+        exercise_index = workout_data.get('_exercises_by_id')
+        if exercise_index is None:
+            exercise_index = {}
+            for ex in workout_data.get('exercises', []):
+                ex_id = ex.get('exerciseId')
+                # Malformed ids can't be looked up, so they are left out of the index
+                if isinstance(ex_id, str):
+                    exercise_index.setdefault(ex_id, ex)
+            workout_data['_exercises_by_id'] = exercise_index
+        return exercise_index
+
+    def get_workout_movement_patterns(workout_data):
+        """Get the set of movement patterns trained in a workout, memoized on the decoded log."""
+        movement_patterns = workout_data.get('_movement_patterns')
+        if movement_patterns is None:
+            movement_patterns = {
+                get_exercise_metadata(ex.get('exerciseId'))['movementPattern']
+                for ex in workout_data.get('exercises', [])
+            }
+            workout_data['_movement_patterns'] = movement_patterns
+        return movement_patterns
+
     def calculate_staleness_score(exercise_id, user_id, current_date, recent_workouts):
         """Calculate exercise staleness score (days since last variation)."""
         try:
             days_since_variation = 0
             found_variation = False
+            target_pattern = get_exercise_metadata(exercise_id)['movementPattern']
+            current_date_normalized = normalize_datetime(current_date)
             
-            for doc in recent_workouts:
-                workout_data = doc.to_dict()
-                workout_date = workout_data.get('completedDate') or workout_data.get('date')
+            for _, workout_data in recent_workouts:
+                # Dates are normalized once when each log is decoded
+                workout_date_normalized = workout_data['_normalized_date']
                 
-                if workout_date:
-                    # Normalize both dates for comparison
-                    current_date_normalized = normalize_datetime(current_date)
-                    workout_date_normalized = normalize_datetime(workout_date)
-                    
-                    if current_date_normalized and workout_date_normalized:
+                if workout_date_normalized:
+                    if current_date_normalized:
                         days_diff = (current_date_normalized - workout_date_normalized).days
                     
                     # Check if this workout contains the same exercise
-                    exercises = workout_data.get('exercises', [])
-                    has_exercise = any(ex.get('exerciseId') == exercise_id for ex in exercises)
+                    has_exercise = exercise_id in get_workout_exercise_index(workout_data)
                     
                     if has_exercise:
                         days_since_variation = days_diff
                     else:
                         # Check for similar exercises (same movement pattern)
-                        metadata = get_exercise_metadata(exercise_id)
-                        has_similar_exercise = any(
-                            get_exercise_metadata(ex.get('exerciseId'))['movementPattern'] == metadata['movementPattern']
-                            for ex in exercises
-                        )
-                        
-                        if has_similar_exercise:
+                        if target_pattern in get_workout_movement_patterns(workout_data):
                             found_variation = True
                             break
             
@@ -246,78 +525,58 @@ def process_workouts():
             print(f"Error calculating staleness for exercise {exercise_id}: {e}")
             return 0
 
-    def detect_plateau(exercise_id, user_id, recent_workouts):
+    def detect_plateau(exercise_id, bodyweight, recent_workouts):
         """Detect plateau in exercise progress."""
         try:
-            e1rm_history = []
+            # e1RM history kept as parallel sequences rather than a dict per entry
+            history_dates = []
+            history_normalized_dates = []
+            history_e1rms = array.array('d')
             
-            for doc in recent_workouts:
-                workout_data = doc.to_dict()
-                exercises = workout_data.get('exercises', [])
-                exercise = next((ex for ex in exercises if ex.get('exerciseId') == exercise_id), None)
+            for _, workout_data in recent_workouts:
+                exercise = get_workout_exercise_index(workout_data).get(exercise_id)
                 
                 if exercise:
                     max_e1rm = 0
                     metadata = get_exercise_metadata(exercise_id)
                     
-                    # Handle both data structures
-                    if 'sets' in exercise and isinstance(exercise['sets'], list):
-                        # Current data structure
-                        for set_data in exercise['sets']:
-                            weight = set_data.get('weight', 0)
-                            reps = set_data.get('reps', 0)
-                            if reps > 0:
-                                # Handle bodyweight exercises
-                                effective_weight = weight
-                                if metadata['exerciseType'] == 'Bodyweight':
-                                    effective_weight = get_user_bodyweight(user_id)
-                                elif metadata['exerciseType'] == 'Bodyweight Loadable':
-                                    effective_weight = get_user_bodyweight(user_id) + weight
-                                
-                                set_e1rm = effective_weight * (1 + (reps / 30))
-                                max_e1rm = max(max_e1rm, set_e1rm)
-                    else:
-                        # Historical data structure
-                        reps_list = exercise.get('reps', [])
-                        weight_list = exercise.get('weights', [])
-                        completed_list = exercise.get('completed', [])
-                        num_sets = min(len(reps_list), len(weight_list), len(completed_list))
+                    exercise_type = metadata['exerciseType']
+                    for weight, reps in iter_completed_sets(exercise):
+                        # Handle bodyweight exercises
+                        effective_weight = weight
+                        if exercise_type == 'Bodyweight':
+                            effective_weight = bodyweight
+                        elif exercise_type == 'Bodyweight Loadable':
+                            effective_weight = bodyweight + weight
                         
-                        for i in range(num_sets):
-                            if completed_list[i]:
-                                reps = int(reps_list[i]) if reps_list[i] else 0
-                                weight = int(weight_list[i]) if weight_list[i] else 0
-                                if reps > 0:
-                                    effective_weight = weight
-                                    if metadata['exerciseType'] == 'Bodyweight':
-                                        effective_weight = get_user_bodyweight(user_id)
-                                    elif metadata['exerciseType'] == 'Bodyweight Loadable':
-                                        effective_weight = get_user_bodyweight(user_id) + weight
-                                    
-                                    set_e1rm = effective_weight * (1 + (reps / 30))
-                                    max_e1rm = max(max_e1rm, set_e1rm)
+                        set_e1rm = effective_weight * (1 + (reps / 30))
+                        max_e1rm = max(max_e1rm, set_e1rm)
                     
                     if max_e1rm > 0:
                         workout_date = workout_data.get('completedDate') or workout_data.get('date')
-                        e1rm_history.append({
-                            'date': workout_date,
-                            'e1RM': max_e1rm
-                        })
+                        history_dates.append(workout_date)
+                        history_normalized_dates.append(workout_data['_normalized_date'])
+                        history_e1rms.append(max_e1rm)
             
-            if len(e1rm_history) < 4:
+            if len(history_e1rms) < 4:
                 return {'isPlateaued': False, 'plateauDays': 0, 'trend': 'insufficient_data'}
             
-            # Sort by date (oldest first)
-            e1rm_history.sort(key=lambda x: x['date'])
+            # Take the indices of the 4 most recent entries without sorting the
+            # whole history, then order them oldest first. Ties on date go to the
+            # later entry, matching a stable sort by date followed by [-4:]
+            recent_4 = heapq.nlargest(4, range(len(history_dates)), key=lambda i: (history_dates[i], i))
+            recent_4.reverse()
             
             # Check for plateau (no improvement in last 4 workouts)
-            recent_4 = e1rm_history[-4:]
-            max_recent = max(h['e1RM'] for h in recent_4)
-            is_plateaued = all(h['e1RM'] <= max_recent * 1.02 for h in recent_4)  # Allow 2% variance
+            # Unpack the four values once; the checks below are plain float math
+            e1rm_0, e1rm_1, e1rm_2, e1rm_3 = (history_e1rms[i] for i in recent_4)
+            variance_limit = max(e1rm_0, e1rm_1, e1rm_2, e1rm_3) * 1.02  # Allow 2% variance
+            is_plateaued = (e1rm_0 <= variance_limit and e1rm_1 <= variance_limit and
+                            e1rm_2 <= variance_limit and e1rm_3 <= variance_limit)
             
             # Calculate trend
-            first_2_avg = (recent_4[0]['e1RM'] + recent_4[1]['e1RM']) / 2
-            last_2_avg = (recent_4[2]['e1RM'] + recent_4[3]['e1RM']) / 2
+            first_2_avg = (e1rm_0 + e1rm_1) / 2
+            last_2_avg = (e1rm_2 + e1rm_3) / 2
             trend_percent = ((last_2_avg - first_2_avg) / first_2_avg) * 100
             
             trend = 'stable'
@@ -328,9 +587,8 @@ def process_workouts():
             
             plateau_days = 0
             if is_plateaued:
-                # Normalize dates for comparison
-                start_date_normalized = normalize_datetime(recent_4[0]['date'])
-                end_date_normalized = normalize_datetime(recent_4[3]['date'])
+                start_date_normalized = history_normalized_dates[recent_4[0]]
+                end_date_normalized = history_normalized_dates[recent_4[3]]
                 
                 if start_date_normalized and end_date_normalized:
                     plateau_days = (end_date_normalized - start_date_normalized).days
@@ -393,380 +651,491 @@ def process_workouts():
             print(f"Error calculating muscle balance for user {user_id}: {e}")
             return {'muscleGroupStrength': {}, 'ratios': {}}
 
+    def content_hash(data):
+        """Stable hash of a document's content, ignoring its lastUpdated timestamp."""
+        try:
+            encoded = json.dumps({key: value for key, value in data.items() if key != 'lastUpdated'},
+                                 sort_keys=True, default=str)
+        except TypeError:
+            return None  # Content that can't be serialized stably is always written
+        return hashlib.blake2b(encoded.encode(), digest_size=16).hexdigest()
+
+    def save_written_hashes():
+        """Persist the hashes of documents this run wrote or found unchanged."""
+        try:
+            with open(WRITTEN_HASHES_PATH, 'w') as hashes_file:
+                json.dump({'target': firestore_target, 'hashes': written_hashes}, hashes_file)
+        except Exception as e:
+            print(f"Error saving written document hashes '{WRITTEN_HASHES_PATH}': {e}")
+
+    def commit_with_retry(batch, user_id):
+        """Commit a batch, retrying transient errors. Batches only contain sets, so a retry is idempotent."""
+        for attempt in range(1, COMMIT_MAX_ATTEMPTS + 1):
+            try:
+                batch.commit()
+                return True
+            except RETRYABLE_COMMIT_ERRORS as e:
+                if attempt == COMMIT_MAX_ATTEMPTS:
+                    print(f"Error committing batch for user {user_id} after {attempt} attempts: {e}")
+                    return False
+                time.sleep(0.5 * 2 ** (attempt - 1))
+            except Exception as e:
+                print(f"Error committing batch for user {user_id}: {e}")
+                return False
+
+    def write_user_analytics(user_id, user_data):
+        """Build and commit one user's exercise and monthly analytics."""
+        server_timestamp = firestore.SERVER_TIMESTAMP
+        print(f"Writing enhanced data for user: {user_id}")
+
+        # Muscle balance only reads the user's stored exercise analytics, which don't
+        # change while logs are processed, so it is calculated once per user rather
+        # than once per workout log. It must be read before any of this user's
+        # batches are committed.
+        muscle_balance = calculate_muscle_balance(user_id)
+
+        # Collection references are built once per user rather than once per document
+        user_analytics_ref = db.collection('userAnalytics').document(user_id)
+        exercise_analytics_ref = user_analytics_ref.collection('exerciseAnalytics')
+        monthly_analytics_ref = user_analytics_ref.collection('monthlyAnalytics')
+
+        batch = db.batch()
+        batch_ops = 0
+        # Hashes of the documents in the current batch, recorded once it commits
+        batch_hashes = {}
+        unchanged_docs = 0
+        all_committed = True
+
+        def commit_batch():
+            nonlocal batch, batch_ops, all_committed
+            if commit_with_retry(batch, user_id):
+                written_hashes.update(batch_hashes)
+            else:
+                all_committed = False
+            batch = db.batch()
+            batch_ops = 0
+            batch_hashes.clear()
+
+        def set_doc(doc_ref, data):
+            """Add a set to the current batch unless the document is unchanged since the
+            previous run, committing the batch once it reaches BATCH_OP_LIMIT."""
+            nonlocal batch_ops, unchanged_docs
+            doc_hash = content_hash(data)
+            if doc_hash is not None and previous_written_hashes.get(doc_ref.path) == doc_hash:
+                written_hashes[doc_ref.path] = doc_hash
+                unchanged_docs += 1
+                return
+            batch.set(doc_ref, data)
+            batch_ops += 1
+            if doc_hash is not None:
+                batch_hashes[doc_ref.path] = doc_hash
+            if batch_ops >= BATCH_OP_LIMIT:
+                commit_batch()
+
+        # Set exercise analytics with enhanced structure
+        for exercise_id, exercise_data in user_data["exercise_analytics"].items():
+            # Calculate final average intensity
+            if exercise_data["totalReps"] > 0:
+                exercise_data["averageIntensity"] = exercise_data["totalVolume"] / exercise_data["totalReps"]
+            else:
+                exercise_data["averageIntensity"] = 0
+            
+            exercise_data["intensityDistribution"] = dict(exercise_data["intensityDistribution"])
+            exercise_data["lastUpdated"] = server_timestamp
+            
+            doc_ref = exercise_analytics_ref.document(exercise_id)
+            set_doc(doc_ref, exercise_data)
+
+            # Store PR History in subcollection. prsByRepRange on the parent doc holds
+            # the same data, but PRTracker and CompoundLiftTracker read the prHistory
+            # documents and processWorkout keeps them current, so both are written
+            for rep_range, pr_data in exercise_data.get("prsByRepRange", {}).items():
+                pr_history_ref = doc_ref.collection('prHistory').document(rep_range)
+                set_doc(pr_history_ref, {
+                    'repRange': rep_range,
+                    'e1RM': pr_data['e1RM'],
+                    'weight': pr_data['weight'],
+                    'reps': pr_data['reps'],
+                    'achievedDate': pr_data['date'],
+                    'exerciseName': exercise_data['exerciseName'],
+                    'lastUpdated': server_timestamp,
+                })
+
+        # Set monthly analytics with enhanced structure
+        for month_key, monthly_data in user_data["monthly_analytics"].items():
+            monthly_data["muscleGroupVolume"] = dict(monthly_data["muscleGroupVolume"])
+            monthly_data["compoundLiftVolume"] = dict(monthly_data["compoundLiftVolume"])
+            monthly_data["muscleBalance"] = muscle_balance
+            monthly_data["lastUpdated"] = server_timestamp
+            doc_ref = monthly_analytics_ref.document(format_month_key(month_key))
+            set_doc(doc_ref, monthly_data)
+            
+        if batch_ops:
+            commit_batch()
+        if all_committed:
+            print(f"Successfully committed enhanced analytics for user: {user_id} ({unchanged_docs} unchanged documents skipped)")
+
+    # Each user's analytics are handed to this pool as soon as they are aggregated,
+    # so commits overlap with processing the next user and finished users can be
+    # freed instead of holding every user's analytics until the end. The executor's
+    # queue is unbounded, so the semaphore caps how many users wait in it.
+    write_executor = ThreadPoolExecutor(max_workers=COMMIT_WORKERS)
+    pending_writes = threading.BoundedSemaphore(MAX_PENDING_WRITES)
+    write_futures = []
+
     # --- 1. Fetch all completed workout logs ---
     try:
         print("Fetching completed workout logs from 'workoutLogs' collection group...")
-        logs_ref = db.collection_group('workoutLogs').where('isWorkoutFinished', '==', True)
-        all_logs = logs_ref.stream()
         
         # First pass: organize workouts by user
         user_workouts = {}
-        for log in all_logs:
-            log_data = log.to_dict()
+        referenced_exercise_ids = set()
+        for log_id, log_data in read_finished_logs():
             user_id = log_data.get('userId')
             if user_id:
+                # Normalize once here rather than on every staleness/plateau comparison
+                workout_date = log_data.get('completedDate') or log_data.get('date')
+                log_data['_normalized_date'] = normalize_datetime(workout_date)
+                # Months are keyed by integer until write time instead of formatting a
+                # 'YYYY-MM' string per log
+                log_data['_month_key'] = get_month_key(workout_date)
                 if user_id not in user_workouts:
                     user_workouts[user_id] = []
-                user_workouts[user_id].append(log)  # Store the Firestore document object
+                # Keep the decoded dict so later passes never re-parse the snapshot
+                user_workouts[user_id].append((log_id, log_data))
+                for exercise in log_data.get('exercises') or []:
+                    if not isinstance(exercise, dict):
+                        continue
+                    # Set data is parsed and validated once here, so the processing
+                    # loop can run over it without per-exercise error handling
+                    exercise['_completed_sets'] = parse_completed_sets(exercise)
+                    exercise_id = exercise.get('exerciseId')
+                    # Malformed ids are skipped when the exercise is processed
+                    if exercise_id and isinstance(exercise_id, str):
+                        referenced_exercise_ids.add(exercise_id)
+
+        # Warm both caches up front so the processing loop doesn't pay one
+        # Firestore round-trip per previously unseen exercise or user
+        print(f"Prefetching metadata for {len(referenced_exercise_ids)} exercises and {len(user_workouts)} users...")
+        prefetch_exercise_metadata(referenced_exercise_ids)
+        prefetch_user_bodyweights(user_workouts.keys())
         
         # Sort each user's workouts by date (newest first)
         for user_id in user_workouts:
             user_workouts[user_id].sort(
-                key=lambda log: log.to_dict().get('completedDate') or log.to_dict().get('date'),
+                key=lambda entry: entry[1].get('completedDate') or entry[1].get('date'),
                 reverse=True
             )
         
         log_count = 0
-        # Second pass: process each workout
-        for user_id, user_logs in user_workouts.items():
-            for log in user_logs:
-                log_count += 1
-                log_data = log.to_dict()
-                
-                user_id = log_data.get('userId')
-                exercises = log_data.get('exercises', [])
+        user_count = 0
+        print("\nWriting enhanced aggregated analytics to Firestore as each user is processed...")
+        # Second pass: process each workout. Each user's logs are dropped once the
+        # user is processed
+        for user_id in list(user_workouts):
+            user_logs = user_workouts.pop(user_id)
+            try:
+                # Staleness and plateau use the user's 20 most recent workouts (already
+                # decoded and sorted newest first), so slice them once per user
+                recent_workouts = user_logs[:20]
+                # detect_plateau only depends on those workouts, the exercise and the
+                # user's bodyweight, so it is computed once per exercise for the user
+                plateau_by_exercise = {}
+
+                # Logs are sorted by date, so each month's logs are contiguous. Workouts are
+                # summed into month totals first and merged into monthly_analytics once per
+                # month rather than once per log
+                for month_key, month_logs in groupby(user_logs, key=lambda entry: entry[1]['_month_key']):
+                    month_volume = 0
+                    month_workouts = 0
+                    month_effective_reps = 0
+                    month_muscle_group_volume = Counter()
+                    month_compound_lift_volume = Counter()
+
+                    for log_id, log_data in month_logs:
+                        log_count += 1
                 
-                # The date of the workout is needed for monthly analytics
-                workout_date = log_data.get('completedDate')
-                if not workout_date:
-                    # Fallback to the 'date' field if 'completedDate' is missing
-                    workout_date = log_data.get('date')
-
-                print(f"\nProcessing log {log.id} (User: {user_id}) with {len(exercises)} exercises. Date: {workout_date}")
-
-                if not user_id or not exercises or not workout_date:
-                    print(f"Skipping log {log.id} due to missing 'userId', 'exercises', or date.")
-                    continue
-
-                # Ensure user exists in our analytics dictionary
-                if user_id not in all_users_analytics:
-                    all_users_analytics[user_id] = {
-                        "exercise_analytics": {},
-                        "monthly_analytics": {}
-                    }
-
-                # --- 2. Process each exercise in the log with enhanced analytics ---
-                total_workout_volume = 0
-                total_effective_reps = 0
-                muscle_group_volume = {}
-                compound_lift_volume = {}
+                        user_id = log_data.get('userId')
+                        exercises = log_data.get('exercises', [])
                 
-                for exercise in exercises:
-                    try:
-                        exercise_id = exercise.get('exerciseId')
-                        if not exercise_id:
-                            print(f"    Skipping exercise due to missing 'exerciseId'.")
+                        # The date of the workout is needed for monthly analytics
+                        workout_date = log_data.get('completedDate')
+                        if not workout_date:
+                            # Fallback to the 'date' field if 'completedDate' is missing
+                            workout_date = log_data.get('date')
+
+                        print(f"\nProcessing log {log_id} (User: {user_id}) with {len(exercises)} exercises. Date: {workout_date}")
+
+                        if not user_id or not exercises or not workout_date:
+                            print(f"Skipping log {log_id} due to missing 'userId', 'exercises', or date.")
                             continue
 
-                        # Get exercise metadata
-                        metadata = get_exercise_metadata(exercise_id)
-                        print(f"  Exercise: {exercise.get('exerciseName', exercise_id)} (Type: {metadata['exerciseType']}, Compound: {metadata['isCompoundLift']})")
+                        # Bodyweight is constant for the user, so look it up once per log
+                        bodyweight = get_user_bodyweight(user_id)
+                        # Bodyweight exercises with sets can't be scored without a usable bodyweight
+                        valid_bodyweight = is_finite_number(bodyweight)
+
+                        # Resolve the user's exercise aggregation dict once per log instead
+                        # of indexing all_users_analytics for every exercise
+                        exercise_analytics = all_users_analytics[user_id]["exercise_analytics"]
+
+                        # --- 2. Process each exercise in the log with enhanced analytics ---
+                        for exercise in exercises:
+                            if not isinstance(exercise, dict):
+                                print(f"    Skipping malformed exercise entry in log {log_id}.")
+                                continue
+
+                            exercise_id = exercise.get('exerciseId')
+                            if not exercise_id:
+                                print(f"    Skipping exercise due to missing 'exerciseId'.")
+                                continue
+                            if not isinstance(exercise_id, str):
+                                print(f"    Skipping exercise with malformed 'exerciseId' {exercise_id!r} in log {log_id}.")
+                                continue
+
+                            # Get exercise metadata
+                            metadata = get_exercise_metadata(exercise_id)
+                            print(f"  Exercise: {exercise.get('exerciseName', exercise_id)} (Type: {metadata['exerciseType']}, Compound: {metadata['isCompoundLift']})")
                         
-                        # Debug: Print exercise structure
-                        print(f"    Exercise structure: {list(exercise.keys())}")
-                        if 'sets' in exercise:
-                            print(f"    Sets type: {type(exercise['sets'])}, Sets value: {exercise['sets']}")
-
-                        # Initialize exercise analytics variables
-                        workout_e1rm = 0
-                        workout_volume = 0
-                        workout_total_reps = 0
-                        workout_total_sets = 0
-                        workout_effective_reps = 0
-                        intensity_distribution = {}
-                        prs_by_rep_range = {}
-                        average_intensity_percent = 0
-                        total_intensity_sum = 0
-                        valid_sets_for_intensity = 0
-
-                        # Get current e1RM for intensity calculations (from existing analytics)
-                        current_e1rm = 0
-                        if exercise_id in all_users_analytics[user_id]["exercise_analytics"]:
-                            current_e1rm = all_users_analytics[user_id]["exercise_analytics"][exercise_id].get("e1RM", 0)
-
-                        # --- Handle both historical and current data structures ---
-                        if 'sets' in exercise and isinstance(exercise['sets'], list):
-                            # Current data structure with sets array
-                            workout_total_sets = len(exercise['sets'])
+                            # Debug: Print exercise structure
+                            print(f"    Exercise structure: {list(exercise.keys())}")
+                            if 'sets' in exercise:
+                                print(f"    Sets type: {type(exercise['sets'])}, Sets value: {exercise['sets']}")
+
+                            # Initialize exercise analytics variables
+                            workout_e1rm = 0
+                            workout_volume = 0
+                            workout_total_reps = 0
+                            workout_total_sets = 0
+                            workout_effective_reps = 0
+                            # Counted by integer bucket; string keys are built once per exercise below
+                            intensity_bucket_counts = Counter()
+                            # Best set per rep range as (rounded e1RM, weight, reps) tuples;
+                            # the PR dicts are only built for the winners, after the set loop
+                            best_sets_by_rep_range = {}
+                            average_intensity_percent = 0
+                            total_intensity_sum = 0
+                            valid_sets_for_intensity = 0
+                            # Parallel weight/rep lists for the effective reps calculation
+                            effective_reps_weights = []
+                            effective_reps_reps = []
+
+                            # Get current e1RM for intensity calculations (from existing analytics)
+                            current_e1rm = 0
+                            if exercise_id in exercise_analytics:
+                                current_e1rm = exercise_analytics[exercise_id]["e1RM"]
+
+                            # Sets were parsed and validated when the log was decoded. This is
+                            # checked first, as historical arrays that aren't lists can't be counted.
+                            completed_sets = exercise['_completed_sets']
+                            if completed_sets is None:
+                                print(f"    [!] Warning: Skipping exercise '{exercise.get('exerciseName', exercise_id)}' in log {log_id} due to malformed set data.")
+                                continue
+
+                            # --- Handle both historical and current data structures ---
+                            uses_sets_array = is_current_set_format(exercise)
+                            if not uses_sets_array and historical_set_count(exercise) == 0:
+                                print(f"    [!] Warning: Skipping exercise '{exercise.get('exerciseName', exercise_id)}' in log {log_id} due to empty set data.")
+                                continue
+
+                            # Classify the exercise type once rather than comparing strings per set
+                            exercise_type = metadata['exerciseType']
+                            is_bodyweight = exercise_type == 'Bodyweight'
+                            is_bodyweight_loadable = exercise_type == 'Bodyweight Loadable'
+
+                            if completed_sets and (is_bodyweight or is_bodyweight_loadable) and not valid_bodyweight:
+                                print(f"    [!] Warning: Skipping exercise '{exercise.get('exerciseName', exercise_id)}' in log {log_id} due to malformed set data.")
+                                continue
+
+                            for weight, reps in completed_sets:
+                                # Handle bodyweight exercises
+                                effective_weight = weight
+                                if is_bodyweight:
+                                    effective_weight = bodyweight
+                                elif is_bodyweight_loadable:
+                                    effective_weight = bodyweight + weight
+
+                                set_e1rm = effective_weight * (1 + (reps / 30))
+                                if set_e1rm > workout_e1rm:
+                                    workout_e1rm = set_e1rm
                             
-                            for set_data in exercise['sets']:
-                                weight = set_data.get('weight', 0)
-                                reps = set_data.get('reps', 0)
-                                
-                                if reps > 0:
-                                    # Handle bodyweight exercises
-                                    effective_weight = weight
-                                    if metadata['exerciseType'] == 'Bodyweight':
-                                        effective_weight = get_user_bodyweight(user_id)
-                                    elif metadata['exerciseType'] == 'Bodyweight Loadable':
-                                        effective_weight = get_user_bodyweight(user_id) + weight
-
-                                    set_e1rm = effective_weight * (1 + (reps / 30))
-                                    if set_e1rm > workout_e1rm:
-                                        workout_e1rm = set_e1rm
-                                    
-                                    workout_volume += effective_weight * reps
-                                    workout_total_reps += reps
-
-                                    # --- Enhanced Analytics Calculations ---
-                                    
-                                    # Calculate intensity percentage
-                                    if current_e1rm > 0:
-                                        intensity_percent = round((effective_weight / current_e1rm) * 100)
-                                        total_intensity_sum += intensity_percent
-                                        valid_sets_for_intensity += 1
-                                        
-                                        # Track intensity distribution
-                                        intensity_bucket = (intensity_percent // 10) * 10  # Round to nearest 10%
-                                        intensity_distribution[str(intensity_bucket)] = intensity_distribution.get(str(intensity_bucket), 0) + 1
-
-                                    # Track PRs by rep range
-                                    rep_range = get_rep_range_category(reps)
-                                    if rep_range not in prs_by_rep_range or set_e1rm > prs_by_rep_range[rep_range]['e1RM']:
-                                        prs_by_rep_range[rep_range] = {
-                                            'e1RM': round(set_e1rm),
-                                            'weight': effective_weight,
-                                            'reps': reps,
-                                            'date': workout_date
-                                        }
+                                workout_volume += effective_weight * reps
+                                workout_total_reps += reps
 
-                            # Calculate effective reps for this exercise
-                            if 'sets' in exercise and isinstance(exercise['sets'], list):
-                                sets_for_effective_reps = [{'weight': s.get('weight', 0), 'reps': s.get('reps', 0)} for s in exercise['sets']]
-                                workout_effective_reps = calculate_effective_reps(sets_for_effective_reps, current_e1rm)
-                            else:
-                                # Fallback for cases where sets is not a list
-                                workout_effective_reps = 0
+                                # --- Enhanced Analytics Calculations ---
                             
-                        else:
-                            # Historical data structure with separate arrays
-                            reps_list = exercise.get('reps', [])
-                            weight_list = exercise.get('weights', [])
-                            completed_list = exercise.get('completed', [])
-                            num_sets = min(len(reps_list), len(weight_list), len(completed_list))
-
-                            if num_sets == 0:
-                                print(f"    [!] Warning: Skipping exercise '{exercise.get('exerciseName', exercise_id)}' in log {log.id} due to empty set data.")
-                                continue
+                                # Calculate intensity percentage
+                                if current_e1rm > 0:
+                                    intensity_percent = round((effective_weight / current_e1rm) * 100)
+                                    total_intensity_sum += intensity_percent
+                                    valid_sets_for_intensity += 1
+                                
+                                    # Track intensity distribution
+                                    intensity_bucket = (intensity_percent // 10) * 10  # Round to nearest 10%
+                                    intensity_bucket_counts[intensity_bucket] += 1
+
+                                # Track PRs by rep range
+                                rep_range = get_rep_range_category(reps)
+                                if rep_range not in best_sets_by_rep_range or set_e1rm > best_sets_by_rep_range[rep_range][0]:
+                                    best_sets_by_rep_range[rep_range] = (round(set_e1rm), effective_weight, reps)
 
-                            completed_sets = []
-                            for i in range(num_sets):
-                                # Only process completed sets
-                                if completed_list[i]:
-                                    reps = int(reps_list[i]) if reps_list[i] else 0
-                                    weight = int(weight_list[i]) if weight_list[i] else 0
-                                    
-                                    if reps > 0:
-                                        # Handle bodyweight exercises
-                                        effective_weight = weight
-                                        if metadata['exerciseType'] == 'Bodyweight':
-                                            effective_weight = get_user_bodyweight(user_id)
-                                        elif metadata['exerciseType'] == 'Bodyweight Loadable':
-                                            effective_weight = get_user_bodyweight(user_id) + weight
-
-                                        set_e1rm = effective_weight * (1 + (reps / 30))
-                                        if set_e1rm > workout_e1rm:
-                                            workout_e1rm = set_e1rm
-                                        
-                                        workout_volume += effective_weight * reps
-                                        workout_total_reps += reps
-                                        workout_total_sets += 1  # Only count completed sets
-
-                                        # --- Enhanced Analytics Calculations ---
-                                        
-                                        # Calculate intensity percentage
-                                        if current_e1rm > 0:
-                                            intensity_percent = round((effective_weight / current_e1rm) * 100)
-                                            total_intensity_sum += intensity_percent
-                                            valid_sets_for_intensity += 1
-                                            
-                                            # Track intensity distribution
-                                            intensity_bucket = (intensity_percent // 10) * 10  # Round to nearest 10%
-                                            intensity_distribution[str(intensity_bucket)] = intensity_distribution.get(str(intensity_bucket), 0) + 1
-
-                                        # Track PRs by rep range
-                                        rep_range = get_rep_range_category(reps)
-                                        if rep_range not in prs_by_rep_range or set_e1rm > prs_by_rep_range[rep_range]['e1RM']:
-                                            prs_by_rep_range[rep_range] = {
-                                                'e1RM': round(set_e1rm),
-                                                'weight': effective_weight,
-                                                'reps': reps,
-                                                'date': workout_date
-                                            }
-
-                                        # Store for effective reps calculation
-                                        completed_sets.append({'weight': effective_weight, 'reps': reps})
+                                # Store for effective reps calculation. Current-format sets
+                                # use the logged weight; historical sets use the effective weight
+                                effective_reps_weights.append(weight if uses_sets_array else effective_weight)
+                                effective_reps_reps.append(reps)
+
+                            # Current-format exercises count every logged set; historical
+                            # ones only count completed sets
+                            workout_total_sets = len(exercise['sets']) if uses_sets_array else len(effective_reps_reps)
 
                             # Calculate effective reps for this exercise
-                            workout_effective_reps = calculate_effective_reps(completed_sets, current_e1rm)
+                            workout_effective_reps = calculate_effective_reps(effective_reps_weights, effective_reps_reps, current_e1rm)
 
-                        # Calculate average intensity percentage
-                        if valid_sets_for_intensity > 0:
-                            average_intensity_percent = round(total_intensity_sum / valid_sets_for_intensity)
+                            prs_by_rep_range = {
+                                rep_range: {'e1RM': pr_e1rm, 'weight': pr_weight, 'reps': pr_reps, 'date': workout_date}
+                                for rep_range, (pr_e1rm, pr_weight, pr_reps) in best_sets_by_rep_range.items()
+                            }
 
-                        # Get recent workouts for staleness and plateau calculations
-                        recent_workouts = user_workouts[user_id][:20]  # Get first 20 (already sorted)
+                            # A Counter so it merges into the stored distribution with one update()
+                            intensity_distribution = Counter({str(bucket): count for bucket, count in intensity_bucket_counts.items()})
 
-                        # Calculate staleness score
-                        staleness_score = calculate_staleness_score(exercise_id, user_id, workout_date, recent_workouts)
+                            # Calculate average intensity percentage
+                            if valid_sets_for_intensity > 0:
+                                average_intensity_percent = round(total_intensity_sum / valid_sets_for_intensity)
 
-                        # Detect plateau for this exercise
-                        plateau_data = detect_plateau(exercise_id, user_id, recent_workouts)
+                            # Calculate staleness score
+                            staleness_score = calculate_staleness_score(exercise_id, user_id, workout_date, recent_workouts)
 
-                        # --- 3. Aggregate exercise analytics in memory with enhanced data ---
-                        exercise_analytics = all_users_analytics[user_id]["exercise_analytics"]
-                        if exercise_id not in exercise_analytics:
-                            exercise_analytics[exercise_id] = {
-                                "exerciseName": metadata['name'],
-                                "muscleGroup": metadata['muscleGroup'],
-                                "exerciseType": metadata['exerciseType'],
-                                "isCompoundLift": metadata['isCompoundLift'],
-                                "movementPattern": metadata['movementPattern'],
-                                "equipment": metadata['equipment'],
-                                "e1RM": workout_e1rm,
-                                "totalVolume": workout_volume,
-                                "totalSets": workout_total_sets,
-                                "totalReps": workout_total_reps,
-                                "totalEffectiveReps": workout_effective_reps,
-                                "averageIntensity": workout_volume / workout_total_reps if workout_total_reps > 0 else 0,
-                                "averageIntensityPercent": average_intensity_percent,
-                                "intensityDistribution": intensity_distribution,
-                                "stalenessScore": staleness_score,
-                                "plateauData": plateau_data,
-                                "prsByRepRange": prs_by_rep_range,
-                            }
-                        else:
-                            # Aggregate by adding totals and finding the max E1RM
-                            ea = exercise_analytics[exercise_id]
-                            # Always refresh metadata from master collection
-                            ea["exerciseName"] = metadata['name']
-                            ea["muscleGroup"] = metadata['muscleGroup']
-                            ea["exerciseType"] = metadata['exerciseType']
-                            ea["isCompoundLift"] = metadata['isCompoundLift']
-                            ea["movementPattern"] = metadata['movementPattern']
-                            ea["equipment"] = metadata['equipment']
+                            # Detect plateau for this exercise
+                            plateau_data = plateau_by_exercise.get(exercise_id)
+                            if plateau_data is None:
+                                plateau_data = detect_plateau(exercise_id, bodyweight, recent_workouts)
+                                plateau_by_exercise[exercise_id] = plateau_data
+
+                            # --- 3. Aggregate exercise analytics in memory with enhanced data ---
+                            if exercise_id not in exercise_analytics:
+                                exercise_analytics[exercise_id] = {
+                                    "exerciseName": metadata['name'],
+                                    "muscleGroup": metadata['muscleGroup'],
+                                    "exerciseType": metadata['exerciseType'],
+                                    "isCompoundLift": metadata['isCompoundLift'],
+                                    "movementPattern": metadata['movementPattern'],
+                                    "equipment": metadata['equipment'],
+                                    "e1RM": workout_e1rm,
+                                    "totalVolume": workout_volume,
+                                    "totalSets": workout_total_sets,
+                                    "totalReps": workout_total_reps,
+                                    "totalEffectiveReps": workout_effective_reps,
+                                    "averageIntensity": workout_volume / workout_total_reps if workout_total_reps > 0 else 0,
+                                    "averageIntensityPercent": average_intensity_percent,
+                                    "intensityDistribution": intensity_distribution,
+                                    "stalenessScore": staleness_score,
+                                    "plateauData": plateau_data,
+                                    "prsByRepRange": prs_by_rep_range,
+                                }
+                            else:
+                                # Aggregate by adding totals and finding the max E1RM
+                                ea = exercise_analytics[exercise_id]
+                                # Metadata fields were set from the master collection when the
+                                # entry was created; the cached metadata can't change mid-run
                             
-                            if workout_e1rm > ea.get("e1RM", 0):
-                                ea["e1RM"] = workout_e1rm
+                                # Entries are always created with every field, so they're indexed directly
+                                if workout_e1rm > ea["e1RM"]:
+                                    ea["e1RM"] = workout_e1rm
                             
-                            ea["totalVolume"] = ea.get("totalVolume", 0) + workout_volume
-                            ea["totalSets"] = ea.get("totalSets", 0) + workout_total_sets
-                            ea["totalReps"] = ea.get("totalReps", 0) + workout_total_reps
-                            ea["totalEffectiveReps"] = ea.get("totalEffectiveReps", 0) + workout_effective_reps
-                            ea["averageIntensity"] = ea["totalVolume"] / ea["totalReps"] if ea["totalReps"] > 0 else 0
-                            ea["averageIntensityPercent"] = average_intensity_percent
-                            ea["stalenessScore"] = staleness_score
-                            ea["plateauData"] = plateau_data
+                                ea["totalVolume"] += workout_volume
+                                ea["totalSets"] += workout_total_sets
+                                ea["totalReps"] += workout_total_reps
+                                ea["totalEffectiveReps"] += workout_effective_reps
+                                ea["averageIntensity"] = ea["totalVolume"] / ea["totalReps"] if ea["totalReps"] > 0 else 0
+                                ea["averageIntensityPercent"] = average_intensity_percent
+                                ea["stalenessScore"] = staleness_score
+                                ea["plateauData"] = plateau_data
                             
-                            # Merge intensity distributions
-                            for bucket, count in intensity_distribution.items():
-                                ea["intensityDistribution"][bucket] = ea["intensityDistribution"].get(bucket, 0) + count
+                                # Merge intensity distributions
+                                ea["intensityDistribution"].update(intensity_distribution)
                             
-                            # Merge PRs by rep range
-                            for rep_range, pr_data in prs_by_rep_range.items():
-                                if rep_range not in ea["prsByRepRange"] or pr_data['e1RM'] > ea["prsByRepRange"][rep_range]['e1RM']:
-                                    ea["prsByRepRange"][rep_range] = pr_data
+                                # Merge PRs by rep range, keeping whichever PR has the higher e1RM
+                                stored_prs = ea["prsByRepRange"]
+                                stored_prs |= {
+                                    rep_range: pr_data for rep_range, pr_data in prs_by_rep_range.items()
+                                    if rep_range not in stored_prs or pr_data['e1RM'] > stored_prs[rep_range]['e1RM']
+                                }
 
-                        total_workout_volume += workout_volume
-                        total_effective_reps += workout_effective_reps
+                            # --- 4. Add the exercise straight into its month's totals ---
+                            month_volume += workout_volume
+                            month_effective_reps += workout_effective_reps
                         
-                        # Track muscle group volume
-                        muscle_group = metadata['muscleGroup']
-                        muscle_group_volume[muscle_group] = muscle_group_volume.get(muscle_group, 0) + workout_volume
+                            # Track muscle group volume
+                            month_muscle_group_volume[metadata['muscleGroup']] += workout_volume
                         
-                        # Track compound lift volume
-                        if metadata['isCompoundLift']:
-                            compound_lift_volume[metadata['name']] = compound_lift_volume.get(metadata['name'], 0) + workout_volume
+                            # Track compound lift volume
+                            if metadata['isCompoundLift']:
+                                month_compound_lift_volume[metadata['name']] += workout_volume
                             
-                    except Exception as e:
-                        print(f"    Error processing exercise {exercise_id}: {e}")
+
+                        month_workouts += 1
+
+                    if not month_workouts:
                         continue
 
-                # --- 4. Aggregate monthly analytics in memory with enhanced data ---
-                month_str = workout_date.strftime('%Y-%m')
-                monthly_analytics = all_users_analytics[user_id]["monthly_analytics"]
-                
-                # Calculate muscle balance ratios
-                muscle_balance = calculate_muscle_balance(user_id)
-                
-                if month_str not in monthly_analytics:
-                    monthly_analytics[month_str] = {
-                        "totalVolume": total_workout_volume,
-                        "totalWorkouts": 1,
-                        "totalEffectiveReps": total_effective_reps,
-                        "muscleGroupVolume": muscle_group_volume,
-                        "compoundLiftVolume": compound_lift_volume,
-                        "muscleBalance": muscle_balance,
-                    }
-                else:
-                    monthly_analytics[month_str]["totalVolume"] += total_workout_volume
-                    monthly_analytics[month_str]["totalWorkouts"] += 1
-                    monthly_analytics[month_str]["totalEffectiveReps"] += total_effective_reps
-                    
-                    # Merge muscle group volumes
-                    for muscle, volume in muscle_group_volume.items():
-                        monthly_analytics[month_str]["muscleGroupVolume"][muscle] = monthly_analytics[month_str]["muscleGroupVolume"].get(muscle, 0) + volume
-                    
-                    # Merge compound lift volumes
-                    for lift, volume in compound_lift_volume.items():
-                        monthly_analytics[month_str]["compoundLiftVolume"][lift] = monthly_analytics[month_str]["compoundLiftVolume"].get(lift, 0) + volume
-                    
-                    # Update muscle balance with latest calculation
-                    monthly_analytics[month_str]["muscleBalance"] = muscle_balance
+                    # --- Aggregate monthly analytics in memory with enhanced data ---
+                    monthly_analytics = all_users_analytics[user_id]["monthly_analytics"]
+                    if month_key not in monthly_analytics:
+                        monthly_analytics[month_key] = {
+                            "totalVolume": month_volume,
+                            "totalWorkouts": month_workouts,
+                            "totalEffectiveReps": month_effective_reps,
+                            "muscleGroupVolume": month_muscle_group_volume,
+                            "compoundLiftVolume": month_compound_lift_volume,
+                        }
+                    else:
+                        # Only reached if a month's logs weren't contiguous in the sort
+                        monthly_analytics[month_key]["totalVolume"] += month_volume
+                        monthly_analytics[month_key]["totalWorkouts"] += month_workouts
+                        monthly_analytics[month_key]["totalEffectiveReps"] += month_effective_reps
+                        monthly_analytics[month_key]["muscleGroupVolume"].update(month_muscle_group_volume)
+                        monthly_analytics[month_key]["compoundLiftVolume"].update(month_compound_lift_volume)
+
+            except Exception as e:
+                # Set data is validated before processing, so this only catches
+                # unexpected errors; the user is dropped rather than written partially
+                print(f"Error processing logs for user {user_id}: {e}")
+                all_users_analytics.pop(user_id, None)
+                continue
+
+            # --- 5. Write the user's aggregated data to Firestore ---
+            # Users whose logs were all skipped have nothing to write
+            user_data = all_users_analytics.pop(user_id, None)
+            if user_data is not None:
+                user_count += 1
+                pending_writes.acquire()
+                try:
+                    future = write_executor.submit(write_user_analytics, user_id, user_data)
+                except Exception:
+                    pending_writes.release()
+                    raise
+                future.add_done_callback(lambda _: pending_writes.release())
+                write_futures.append(future)
 
-        print(f"Processed {log_count} logs in memory for {len(all_users_analytics)} users.")
+        print(f"Processed {log_count} logs in memory for {user_count} users.")
+        save_lookup_caches()
 
     except Exception as e:
         print(f"An error occurred while fetching or processing logs: {e}")
+        # Users already handed to the pool are complete, so let their commits finish
+        write_executor.shutdown(wait=True)
+        save_written_hashes()
         return
 
-    # --- 5. Write aggregated data to Firestore in batches with enhanced structure ---
-    print("\nStarting to write enhanced aggregated analytics to Firestore...")
-    server_timestamp = firestore.SERVER_TIMESTAMP
-
-    for user_id, user_data in all_users_analytics.items():
-        print(f"Writing enhanced data for user: {user_id}")
-        batch = db.batch()
-
-        # Set exercise analytics with enhanced structure
-        for exercise_id, exercise_data in user_data["exercise_analytics"].items():
-            # Calculate final average intensity
-            if exercise_data["totalReps"] > 0:
-                exercise_data["averageIntensity"] = exercise_data["totalVolume"] / exercise_data["totalReps"]
-            else:
-                exercise_data["averageIntensity"] = 0
-            
-            exercise_data["lastUpdated"] = server_timestamp
-            
-            doc_ref = db.collection('userAnalytics').document(user_id).collection('exerciseAnalytics').document(exercise_id)
-            batch.set(doc_ref, exercise_data)
-
-            # Store PR History in subcollection
-            for rep_range, pr_data in exercise_data.get("prsByRepRange", {}).items():
-                pr_history_ref = doc_ref.collection('prHistory').document(rep_range)
-                batch.set(pr_history_ref, {
-                    'repRange': rep_range,
-                    'e1RM': pr_data['e1RM'],
-                    'weight': pr_data['weight'],
-                    'reps': pr_data['reps'],
-                    'achievedDate': pr_data['date'],
-                    'exerciseName': exercise_data['exerciseName'],
-                    'lastUpdated': server_timestamp,
-                })
+    # Wait for the remaining commits
+    write_executor.shutdown(wait=True)
+    for future in write_futures:
+        future.result()
 
-        # Set monthly analytics with enhanced structure
-        for month_str, monthly_data in user_data["monthly_analytics"].items():
-            monthly_data["lastUpdated"] = server_timestamp
-            doc_ref = db.collection('userAnalytics').document(user_id).collection('monthlyAnalytics').document(month_str)
-            batch.set(doc_ref, monthly_data)
-            
-        try:
-            batch.commit()
-            print(f"Successfully committed enhanced analytics for user: {user_id}")
-        except Exception as e:
-            print(f"Error committing batch for user {user_id}: {e}")
+    save_written_hashes()
 
     print("\nEnhanced analytics migration script finished.")
 
 if __name__ == '__main__':
-    process_workouts() 
\ No newline at end of file
+    process_workouts(force_write='--force-write' in sys.argv[1:]) 
\ No newline at end of file